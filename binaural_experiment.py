@@ -58,20 +58,27 @@ import time
 import logging
 import argparse
 import os
-import datetime
-import csv
+import threading
 import numpy as np
 import pandas as pd
+from scipy.signal import butter, sosfilt, sosfilt_zi
 from brainflow.board_shim import BoardShim, BrainFlowInputParams, LogLevels, BoardIds, BrainFlowError
 from PyQt5.QtWidgets import QApplication, QWidget, QLabel, QPushButton, QVBoxLayout
 from PyQt5 import QtCore
 import pyqtgraph as pg
+try:
+    import OpenGL  # noqa: F401 - only needed so pyqtgraph can draw the curves through OpenGL
+    pg.setConfigOption('useOpenGL', True)
+    pg.setConfigOption('enableExperimental', True)
+except ImportError:
+    pass
 import pygame
 import enotools
 from PyQt5.QtCore import QThread, pyqtSignal
 import mne
 
 logging.basicConfig(filename='experiment.log', level=logging.DEBUG) # change this accordingly to set the level of logging 
+logger = logging.getLogger(__name__)
 
 class Graph(QWidget):
     def __init__(self, board_shim, subject_id):
@@ -80,16 +87,38 @@ class Graph(QWidget):
         self.board_shim = board_shim
         self.subject_id = subject_id  # Store the subject ID
         self.exg_channels = BoardShim.get_eeg_channels(self.board_id)
+        self.timestamp_channel = BoardShim.get_timestamp_channel(self.board_id)
         self.sampling_rate = BoardShim.get_sampling_rate(self.board_id)
-        self.update_speed_ms = 50
+        self.update_speed_ms = 33  # ~30 Hz refresh
         self.window_size = 10
         self.num_points = self.window_size * self.sampling_rate
         self.plot_names = ['Quality A2', 'Quality A1', 'Quality C4', 'Quality C3']
         self.mains = None
+        self._experiment_started = False
+        self.filter_interval = 10  # Recompute quality every N updates
+        self._filter_counter = 0
+        self._last_quality = None  # quality of each channel from the last quality run
+        # The plotted traces are filtered causally: only the samples that arrived since the previous
+        # update go through the filter, whose state is carried over in _zi
+        self._sos = None
+        self._zi = None
+        # Ring buffer holding the latest filtered samples of each channel. Every sample is written twice,
+        # at _wp and _wp + num_points, so _ring[:, _wp:_wp + num_points] is always the window in time order
+        self._ring = np.empty((len(self.exg_channels), 2 * self.num_points), dtype=np.float32)
+        self._wp = 0  # write position, i.e. index of the oldest sample once the ring is full
+        self._buf_len = 0  # number of valid samples in the ring
+        self._last_names = [None] * len(self.exg_channels)  # legend text currently shown per channel
+        # Legend colours for bad (< 95), fair (< 99) and good quality, indexed with np.searchsorted
+        self._color_thresholds = np.array([95, 99])
+        self._color_table = [pg.mkColor('r'), pg.mkColor('y'), pg.mkColor('g')]
+        self._last_color_idx = [None] * len(self.exg_channels)  # legend colour currently shown per channel
+        self.min_new_samples = self.sampling_rate // 30  # Samples that must arrive before the plot is updated
+        self._last_filtered_ts = 0.0  # timestamp of the newest sample that went through the display filter
         self.initUI()
         self.show()
 
         self.timer = QtCore.QTimer()
+        self.timer.setTimerType(QtCore.Qt.PreciseTimer)
         self.timer.timeout.connect(self.update)
         self.timer.start(self.update_speed_ms)
 
@@ -115,6 +144,7 @@ class Graph(QWidget):
         self.plots = list()
         self.curves = list()
         self.legends = list()
+        self.label_items = list()
 
         for i in range(len(self.exg_channels)):
             p = self.plot_widget.addPlot(row=i, col=0)
@@ -124,59 +154,104 @@ class Graph(QWidget):
             p.showAxis('bottom', False)
             p.setMenuEnabled('bottom', False)
             p.setYRange(-100, 100, padding=0)
+            p.setClipToView(True)
+            p.setDownsampling(mode='peak', auto=True)
             if i == 0:
                 p.setTitle('Live Enophone Data')
             self.plots.append(p)
-            curve = p.plot(name=self.plot_names[i])
+            curve = p.plot(name=self.plot_names[i], skipFiniteCheck=True, antialias=False)
             self.curves.append(curve)
             self.legends.append(legend)
+            self.label_items.append(legend.getLabel(curve))
 
     def update(self):
         data = self.board_shim.get_current_board_data(self.num_points)
 
-        if data.shape[1] > 3 * self.sampling_rate:
+        # The curves only change when new samples go through the display filter, so nothing is redrawn
+        # until enough of them have arrived (and at least 3 s of data are available for mains detection)
+        new_samples = np.count_nonzero(data[self.timestamp_channel] > self._last_filtered_ts)
+        if new_samples < self.min_new_samples or data.shape[1] <= 3 * self.sampling_rate:
+            return
+
+        # Quality changes slowly, so it is only recomputed every few updates; the traces are updated every time
+        update_quality = self._filter_counter % self.filter_interval == 0
+        self._filter_counter += 1
+        if update_quality:
             if self.mains is None:
                 self.mains = enotools.detect_mains(data)
-            quality = enotools.quality(data)
-            data = enotools.referencing(data, mode='mastoid')
-            data = enotools.signal_filtering(data, filter_cut=250, bandpass_range=[3, 40], bandstop_range=self.mains)
-
+            self._last_quality = enotools.quality(data)
+
+        # Reference and filter only the new samples and write them into the ring buffer
+        if self._sos is None:
+            new_samples = data.shape[1]  # First filtered update: run the filter over the whole window
+        chunk = enotools.referencing(data[:, -new_samples:], mode='mastoid')[self.exg_channels]
+        if self._sos is None:
+            self._init_stream_filter(chunk[:, 0])
+        filtered, self._zi = sosfilt(self._sos, chunk, axis=-1, zi=self._zi)
+        self._last_filtered_ts = data[self.timestamp_channel, -1]
+        first = min(new_samples, self.num_points - self._wp)
+        for offset in (0, self.num_points):
+            self._ring[:, offset + self._wp:offset + self._wp + first] = filtered[:, :first]
+            self._ring[:, offset:offset + new_samples - first] = filtered[:, first:]
+        self._wp = (self._wp + new_samples) % self.num_points
+        self._buf_len = min(self._buf_len + new_samples, self.num_points)
+        end = self._wp + self.num_points
+
+        for count, channel in enumerate(self.exg_channels):
+            self.curves[count].setData(self._ring[count, end - self._buf_len:end])
+
+        if update_quality:
+            quality = self._last_quality
+            color_idx = np.searchsorted(self._color_thresholds, quality, side='right')
+            color_idx = np.where(np.isfinite(quality), color_idx, 0)  # NaN (e.g. flat signal) sorts last, show it as bad
             for count, channel in enumerate(self.exg_channels):
                 name = self.plot_names[count] + ': ' + str(quality[count])
-                self.curves[count].setData(data[channel].tolist())
-                self.legends[count].getLabel(self.curves[count]).setText(name)
-                if quality[count] >= 99:
-                    self.legends[count].setLabelTextColor('g')
-                elif quality[count] >= 95:
-                    self.legends[count].setLabelTextColor('y')
-                else:
-                    self.legends[count].setLabelTextColor('r')
-
-            # Save data to CSV (chunks of data - no need to do it now, this is for saving on the fly)
-            #board_id = self.board_shim.get_board_id()
-            #timestamps = data[BoardShim.get_timestamp_channel(board_id)]
-            #markers = data[BoardShim.get_marker_channel(board_id)].astype(int)
-            #human_readable_timestamps = [datetime.datetime.fromtimestamp(ts).strftime('%Y-%m-%d %H:%M:%S.%f') for ts in timestamps]
-            #eeg_data = [data[channel] for channel in self.exg_channels]
-            #combined_data = zip(timestamps, human_readable_timestamps, *eeg_data, markers)
-
-            #for row in combined_data:
-            #    self.csv_writer.writerow(row)
-            #    #logging.debug(f"Row written to CSV: {row}")
-
-            #self.csv_file.flush()
+                if name == self._last_names[count] and color_idx[count] == self._last_color_idx[count]:
+                    continue
+                self.label_items[count].setText(name, color=self._color_table[color_idx[count]])
+                self._last_names[count] = name
+                self._last_color_idx[count] = color_idx[count]
+
+        # Save data to CSV (chunks of data - no need to do it now, this is for saving on the fly)
+        #board_id = self.board_shim.get_board_id()
+        #timestamps = data[BoardShim.get_timestamp_channel(board_id)]
+        #markers = data[BoardShim.get_marker_channel(board_id)].astype(int)
+        #human_readable_timestamps = [datetime.datetime.fromtimestamp(ts).strftime('%Y-%m-%d %H:%M:%S.%f') for ts in timestamps]
+        #eeg_data = [data[channel] for channel in self.exg_channels]
+        #combined_data = zip(timestamps, human_readable_timestamps, *eeg_data, markers)
+
+        #for row in combined_data:
+        #    self.csv_writer.writerow(row)
+        #    #logger.debug("Row written to CSV: %s", row)
+
+        #self.csv_file.flush()
+
+    def _init_stream_filter(self, first_samples):
+        nyquist_f = self.sampling_rate / 2
+        self._sos = np.vstack([
+            butter(N=4, Wn=np.array([3, 40]) / nyquist_f, btype='bandpass', output='sos'),
+            butter(N=4, Wn=np.array(self.mains) / nyquist_f, btype='bandstop', output='sos'),
+        ])
+        # Start from the steady state for the first sample, so the traces do not open with a step response
+        self._zi = sosfilt_zi(self._sos)[:, None, :] * first_samples[None, :, None]
 
     def start_experiment(self):
         self.timer.stop()
+        self._experiment_started = True
         self.close()
-        self.experiment_window = ExperimentWindow(self.board_shim, self.subject_id)
+        self.experiment_window = ExperimentWindow(self.board_shim, self.subject_id, self.mains)
         self.experiment_window.show()
         self.experiment_window.run_experiment()
 
     def closeEvent(self, event):
         #self.csv_file.close() #only if saving real time  chunks of data
+        if not self._experiment_started:
+            QApplication.quit()  # Closed without running the experiment, nothing left to save
         super().closeEvent(event)
 
+class _ExperimentStopped(Exception):
+    """Raised inside ExperimentWorker when stop() interrupts the protocol."""
+
 class ExperimentWorker(QThread):
     finished = pyqtSignal()
     update_message = pyqtSignal(str, int)
@@ -191,73 +266,107 @@ class ExperimentWorker(QThread):
         self.sleep_time = sleep_time
         self.song_directory = song_directory
 
+        # Negotiate with the audio driver once instead of before every song
+        try:
+            pygame.mixer.init()
+        except pygame.error as e:
+            logger.error("Error initialising audio: %s", e)
+
+        self._stop_event = threading.Event()  # Set by stop() to wake the protocol out of its waits
+
     def run(self):
         try:
-  
+            # Decode every song into memory before the protocol starts, so no disk I/O happens during it
+            songs = self.load_songs()
+
             self.board_shim.insert_marker(5)  # Start of experiment
-            logging.debug("Inserted marker 5 (Start of experiment)")
-            time.sleep(sleep_time)
+            logger.debug("Inserted marker 5 (Start of experiment)")
+            self._sleep(sleep_time)
             
             self.update_message.emit("Relax with eyes closed", relax_duration)
             self.board_shim.insert_marker(1)
-            logging.debug("Inserted marker 1 (Start of relaxation)")
-            time.sleep(relax_duration)
-            time.sleep(sleep_time)
+            logger.debug("Inserted marker 1 (Start of relaxation)")
+            self._sleep(relax_duration)
+            self._sleep(sleep_time)
 
             #self.board_shim.insert_marker(2)
-            #logging.debug("Inserted marker 2 (End of relaxation)")
-            #time.sleep(sleep_time)
+            #logger.debug("Inserted marker 2 (End of relaxation)")
+            #self._sleep(sleep_time)
             
             for i in range(num_songs):
-                song_path = f'{song_directory}/song{i + 1:03d}.mp3'
-                if not os.path.exists(song_path):
-                    raise FileNotFoundError(f"Song file not found: {song_path}")
-
                 self.update_message.emit(f"Song {i + 1}", song_duration)
                 self.board_shim.insert_marker(3)
-                logging.debug(f"Inserted marker 3 (Start of song {i + 1})")
+                logger.debug("Inserted marker 3 (Start of song %d)", i + 1)
                 
-                self.play_song(song_path, song_duration)
+                self.play_song(songs[i], song_duration)
                 #self.board_shim.insert_marker(4)
-                #logging.debug(f"Inserted marker 4 (End of song {i + 1})")
-                time.sleep(sleep_time)
+                #logger.debug("Inserted marker 4 (End of song %d)", i + 1)
+                self._sleep(sleep_time)
 
                 self.update_message.emit("Relax", pause_duration)
                 self.board_shim.insert_marker(1)
-                logging.debug("Inserted marker 1 (Start of relaxation)")
-                time.sleep(pause_duration)
-                time.sleep(sleep_time)
+                logger.debug("Inserted marker 1 (Start of relaxation)")
+                self._sleep(pause_duration)
+                self._sleep(sleep_time)
                 #self.board_shim.insert_marker(2)
-                #logging.debug("Inserted marker 2 (End of relaxation)")
+                #logger.debug("Inserted marker 2 (End of relaxation)")
 
+        except _ExperimentStopped:
+            logger.info("Experiment stopped before completion")
         except Exception as e:
-            logging.error(f"Error in experiment: {e}")
+            logger.error("Error in experiment: %s", e)
         finally:
             self.update_message.emit("Experiment Complete", 5)
             self.finished.emit()
 
-    def play_song(self, song_path, duration):
+    def _sleep(self, seconds):
+        # Like time.sleep, but wakes up as soon as stop() is called
+        if self._stop_event.wait(seconds):
+            raise _ExperimentStopped()
+
+    def stop(self):
+        self._stop_event.set()
+
+    def load_songs(self):
+        # Without a working mixer the protocol still runs with the same timing, only without sound
+        audio_available = pygame.mixer.get_init() is not None
+        if not audio_available:
+            logger.error("Audio is not available, the experiment will run without playing the songs")
+        songs = []
+        for i in range(self.num_songs):
+            song_path = f'{self.song_directory}/song{i + 1:03d}.mp3'
+            if not os.path.exists(song_path):
+                raise FileNotFoundError(f"Song file not found: {song_path}")
+            songs.append(pygame.mixer.Sound(song_path) if audio_available else None)
+        return songs
+
+    def play_song(self, sound, duration):
+        if sound is None:
+            self._sleep(duration)
+            return
         try:
-            pygame.mixer.init()
-            pygame.mixer.music.load(song_path)
-            pygame.mixer.music.play()
-            time.sleep(duration)
-            pygame.mixer.music.stop()
+            sound.play()
+            self._sleep(duration)
+        except _ExperimentStopped:
+            raise
         except Exception as e:
-            logging.error(f"Error playing song: {e}")
-
+            logger.error("Error playing song: %s", e)
+        finally:
+            sound.stop()
 
 
 class ExperimentWindow(QWidget):
-    def __init__(self, board_shim, subject_id):
+    def __init__(self, board_shim, subject_id, mains=None):
         super().__init__()
         self.board_shim = board_shim
         self.subject_id = subject_id
+        self.mains = mains  # Mains frequency band already detected by the live graph, if any
         self.initUI()
 
         self.worker = ExperimentWorker(board_shim, relax_duration, song_duration, pause_duration, num_songs, sleep_time, song_directory)
         self.worker.update_message.connect(self.show_message)
         self.worker.finished.connect(self.experiment_finished)
+        self.worker.finished.connect(QApplication.quit)  # Only quit once the data has been saved
 
     def initUI(self):
         self.setGeometry(100, 100, 800, 600)
@@ -282,67 +391,93 @@ class ExperimentWindow(QWidget):
     def run_experiment(self):
         self.worker.start()
 
+    def closeEvent(self, event):
+        self.worker.stop()  # Closing the window ends the protocol early; the recorded data is still saved
+        super().closeEvent(event)
+
     def experiment_finished(self):
         self.board_shim.insert_marker(6)  # End of experiment
-        logging.debug("Inserted marker 6 (End of experiment)")
+        logger.debug("Inserted marker 6 (End of experiment)")
         time.sleep(sleep_time)
 
         self.close()
         board_id = self.board_shim.get_board_id()
+        eeg_channels = BoardShim.get_eeg_channels(board_id)
+        stim_channel = BoardShim.get_marker_channel(board_id)
+        timestamp_channel = BoardShim.get_timestamp_channel(board_id)
+        eeg_names = BoardShim.get_eeg_names(board_id)
+        sfreq = BoardShim.get_sampling_rate(board_id)
         data = self.board_shim.get_board_data()  # Get all data - the experiment has ended
 
         #should pre-process the data before storing them
-        mains = enotools.detect_mains(data)
+        if self.mains is None:
+            self.mains = enotools.detect_mains(data)
         data = enotools.referencing(data, mode='mastoid')
-        data = enotools.signal_filtering(data, filter_cut=250, bandpass_range=[0.1, 45], bandstop_range=mains)
+        data = enotools.signal_filtering(data, filter_cut=250, bandpass_range=[0.1, 45], bandstop_range=self.mains)
 
         # Log the marker values
-        markers = data[BoardShim.get_marker_channel(board_id)]
-        logging.debug(f"Markers retrieved: {markers}")
+        markers = data[stim_channel]
+        logger.debug("Markers retrieved: %s", markers)
 
         # Save final data to CSV to use later in any analysis program of choice 
-        timestamps = data[BoardShim.get_timestamp_channel(board_id)]
-        markers = data[BoardShim.get_marker_channel(board_id)].astype(int)
-        human_readable_timestamps = [datetime.datetime.fromtimestamp(ts).strftime('%Y-%m-%d %H:%M:%S.%f') for ts in timestamps]
-        eeg_data = [data[channel] for channel in BoardShim.get_eeg_channels(board_id)]
-        combined_data = zip(timestamps, human_readable_timestamps, *eeg_data, markers)
+        timestamps = data[timestamp_channel]
+        markers = data[stim_channel].astype(int)
+        human_readable_timestamps = format_local_timestamps(timestamps)
+        eeg_block = data[eeg_channels, :].T
 
         output_csv_filename = f'{self.subject_id}_eeg_data.csv'
         output_fif_filename = f'{self.subject_id}_eeg_data.raw.fif'
-        
-        with open(output_csv_filename, 'w', newline='') as csvfile:
-            csv_writer = csv.writer(csvfile)
-            header = ['Unix Timestamp', 'Human Readable Timestamp'] + [f'EEG Channel {ch}' for ch in BoardShim.get_eeg_channels(board_id)] + ['Marker']
-            csv_writer.writerow(header)
-            for row in combined_data:
-                csv_writer.writerow(row)
-                #logging.debug(f"Final row written to CSV: {row}")
 
-        logging.info("Experiment finished and data saved to <subjectID>_eeg_data.csv")
+        # Write the whole recording in one go instead of row by row, building the table column by column
+        columns = {'Unix Timestamp': timestamps, 'Human Readable Timestamp': human_readable_timestamps}
+        for i, ch in enumerate(eeg_channels):
+            columns[f'EEG Channel {ch}'] = eeg_block[:, i]
+        columns['Marker'] = markers
+        pd.DataFrame(columns).to_csv(output_csv_filename, index=False)
 
-        # this is to construct the MNE data format since it is the nicest analysis software!!
-        # Get EEG and Marker Channel Data
-        eeg_channels = BoardShim.get_eeg_channels(board_id)
-        stim_channel = BoardShim.get_marker_channel(board_id)
-        mne_eeg_data = data[eeg_channels, :] / 1000000 #brainflow data are uV, MNE wants that in V
-        marker_data = data[stim_channel, :]
+        logger.info("Experiment finished and data saved to <subjectID>_eeg_data.csv")
 
-        # Combine EEG and Marker Data
-        combined_data = np.vstack([mne_eeg_data, marker_data])
+        # this is to construct the MNE data format since it is the nicest analysis software!!
+        # Combine EEG and Marker Channel Data into a single preallocated array. It is float64 because
+        # RawArray converts to float64 anyway; the file is narrowed to float32 by fmt='single' on save
+        combined_data = np.empty((len(eeg_channels) + 1, data.shape[1]), dtype=np.float64)
+        np.multiply(data[eeg_channels, :], 1e-6, out=combined_data[:-1]) #brainflow data are uV, MNE wants that in V
+        combined_data[-1] = data[stim_channel, :]
 
         # Create Channel Types and Names
         ch_types = ['eeg'] * len(eeg_channels) + ['stim']
-        ch_names = BoardShim.get_eeg_names(board_id) + ['stim']
+        ch_names = eeg_names + ['stim']
 
         # Create MNE Info Object
-        sfreq = BoardShim.get_sampling_rate(board_id)
         info = mne.create_info(ch_names=ch_names, sfreq=sfreq, ch_types=ch_types)
 
         # Create RawArray Object
         raw = mne.io.RawArray(combined_data, info)
 
         # Save to FIF File
-        raw.save(output_fif_filename, overwrite=True)
+        raw.save(output_fif_filename, overwrite=True, fmt='single', buffer_size_sec=10.0, split_size='2GB')
+
+def format_local_timestamps(timestamps):
+    # Vectorised equivalent of datetime.fromtimestamp(ts).strftime(...) for every sample.
+    # The local UTC offset is looked up for the first and last sample only, plus a bisection
+    # for the switch-over sample if the session spans a daylight saving change.
+    utc_offsets = np.full(len(timestamps), time.localtime(timestamps[0]).tm_gmtoff, dtype=np.float64)
+    end_offset = time.localtime(timestamps[-1]).tm_gmtoff
+    if end_offset != utc_offsets[0]:
+        lo, hi = 0, len(timestamps) - 1
+        while hi - lo > 1:
+            mid = (lo + hi) // 2
+            if time.localtime(timestamps[mid]).tm_gmtoff == utc_offsets[0]:
+                lo = mid
+            else:
+                hi = mid
+        utc_offsets[hi:] = end_offset
+
+    # Round to the nearest microsecond like fromtimestamp does (strftime's %f would truncate)
+    local = timestamps + utc_offsets
+    seconds = np.floor(local)
+    micros = seconds.astype(np.int64) * 1000000 + np.round((local - seconds) * 1e6).astype(np.int64)
+    return pd.to_datetime(micros, unit='us').strftime('%Y-%m-%d %H:%M:%S.%f')
 
 def main():
     BoardShim.enable_dev_board_logger()
@@ -368,6 +503,8 @@ def main():
 
         # Create a single QApplication instance
         app = QApplication(sys.argv)
+        # Closing the experiment window must not end the event loop before the recorded data is saved
+        app.setQuitOnLastWindowClosed(False)
 
         # Start Graph window
         graph = Graph(board_shim, args.subject)
@@ -10,13 +10,13 @@ format compatible with BrainFlow.
 
 import numpy as np
 import sys
-from scipy.signal import butter, filtfilt
+from scipy.signal import butter, sosfiltfilt
 
 def filter(signal, lowerbound, upperbound, nyquist_f, filtertype, order):
     bandpass_filter_window = np.array([lowerbound, upperbound]) / nyquist_f
 
-    a, b = butter(N=order, Wn=bandpass_filter_window, btype=filtertype)
-    filtered = filtfilt(a, b, signal)
+    sos = butter(N=order, Wn=bandpass_filter_window, btype=filtertype, output='sos')
+    filtered = sosfiltfilt(sos, signal, axis=-1)
     return filtered
 
 def signal_filtering(data,filter_cut=None,bandpass_range=None,bandstop_range=None, samplerate=250):
@@ -31,8 +31,7 @@ def signal_filtering(data,filter_cut=None,bandpass_range=None,bandstop_range=Non
             print('ERROR: Second value of the bandpass filter must be below 125. The value is: {}'.format(bandpass_range[1]))
             sys.exit(1)
         try:
-            for i in (1,2,3,4):
-                local_data[i] = filter(local_data[i], bandpass_range[0], bandpass_range[1], samplerate/2, filtertype='bandpass', order=4)
+            local_data[(1,2,3,4),:] = filter(local_data[(1,2,3,4),:], bandpass_range[0], bandpass_range[1], samplerate/2, filtertype='bandpass', order=4)
         except BaseException:
             print('ERROR: Bandpass filtering failed. Try setting different parameters.')
             sys.exit(1)
@@ -52,8 +51,7 @@ def signal_filtering(data,filter_cut=None,bandpass_range=None,bandstop_range=Non
             sys.exit(1)
 
         try:
-            for i in (1,2,3,4):
-                local_data[i] = filter(local_data[i], bandstop_range[0], bandstop_range[1], samplerate/2, filtertype='bandstop', order=4)
+            local_data[(1,2,3,4),:] = filter(local_data[(1,2,3,4),:], bandstop_range[0], bandstop_range[1], samplerate/2, filtertype='bandstop', order=4)
         except BaseException:
             print('ERROR: Bandpass filtering failed. Try setting different parameters.')
             sys.exit(1)
@@ -92,21 +90,14 @@ def quality(data):
     #Should only be used on raw, unreferenced signal.
     fft, freqs = calc_fft(data)
 
-    quality = np.zeros(fft.shape[1])
-    power = np.zeros(fft.shape[1])
-
     ix_power = np.logical_and(freqs >= 10, freqs < 40)
-
-    for i in range(0,fft.shape[1]):
-        chan_fft = fft[:,i].copy()
-        power[i] = np.sum(chan_fft[ix_power])
+    power = np.sum(fft[ix_power,:], axis=0)
 
     #Using A1 or A2 as reference for "best contact"
     #The quality metric will only be relevant as long as one of A1 or A2 touches
     ref = np.max(power[0:2])
 
-    for i in range(0,fft.shape[1]):
-        quality[i] = 1-abs(1-power[i]/ref)
+    quality = 1-np.abs(1-power/ref)
 
     if quality[0] > quality[1]:
         quality[0] = np.max(quality[1:])
@@ -143,10 +134,7 @@ def calc_fft(data):
     ### FFT ###
     samplerate = 250
     nsamples = local_data.shape[1]
-    win = {'none' : 1,
-           'hanning' : np.hanning(nsamples),
-           'hamming' : np.hamming(nsamples)}['hanning']
-    win = np.array([win]).T
+    win = np.hanning(nsamples)[:,None]
 
     fft = np.abs(np.fft.rfft(local_data.T*win, axis=0, norm=None)) * 2 / nsamples
     freqs = np.fft.rfftfreq(nsamples, 1./samplerate)